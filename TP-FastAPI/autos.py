@@ -1,15 +1,20 @@
-from typing import List
+from typing import List, Optional
 
+import orjson
 from fastapi import APIRouter, Depends, HTTPException, status, Query
-from sqlmodel import Session
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy.exc import IntegrityError
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from database import get_session
 from repository import AutoRepository
+from response_cache import invalidate_ventas_cache
 from models import (
+    AutoCountResponse,
     AutoCreate,
+    AutoPageResponse,
     AutoResponse,
     AutoResponseWithVentas,
-    AutoUpdate,
 )
 
 # -------------------------------------------------------------------
@@ -18,16 +23,26 @@ from models import (
 
 router = APIRouter(prefix="/autos", tags=["Autos"])
 
-def get_auto_repository(session: Session = Depends(get_session)) -> AutoRepository:
-    """Provee una instancia del AutoRepository con una sesión activa."""
+async def get_auto_repository(session: AsyncSession = Depends(get_session)) -> AutoRepository:
+    """
+    Provee una instancia del AutoRepository con una sesión activa.
+    Es 'async def' para que FastAPI no la ejecute en el threadpool.
+    """
     return AutoRepository(session)
 
+def not_found(detail: str) -> ORJSONResponse:
+    """
+    Respuesta 404 devuelta directamente, sin lanzar HTTPException: evita el costo
+    de construir y propagar la excepción en búsquedas fallidas frecuentes.
+    """
+    return ORJSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"detail": detail})
+
 # -------------------------------------------------------------------
 # POST /autos - Crear nuevo auto
 # -------------------------------------------------------------------
 
 @router.post("/", response_model=AutoResponse, status_code=status.HTTP_201_CREATED)
-def create_auto(
+async def create_auto(
     auto_data: AutoCreate,
     repository: AutoRepository = Depends(get_auto_repository)
 ):
@@ -35,49 +50,111 @@ def create_auto(
     Crea un nuevo Auto en la base de datos.
     """
     try:
-        new_auto = repository.create(auto_data)
-        return new_auto
-    except Exception as e:
-        # Esto puede capturar errores de unicidad (chasis duplicado)
-        # o fallos de validación del ORM.
+        new_auto = await repository.create(auto_data)
+    except IntegrityError as e:
+        # La unicidad del chasis la garantiza la base de datos (sin consulta previa).
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Error al crear el auto (Verifique chasis único): {e.orig}"
+        )
+    return new_auto
+
+# -------------------------------------------------------------------
+# POST /autos/bulk - Crear varios autos en lote
+# -------------------------------------------------------------------
+
+@router.post("/bulk", response_model=List[AutoResponse], status_code=status.HTTP_201_CREATED)
+async def create_autos_bulk(
+    autos_data: List[AutoCreate],
+    repository: AutoRepository = Depends(get_auto_repository)
+):
+    """
+    Crea varios Autos en una sola transacción (INSERT multi-fila, en lotes).
+    En PostgreSQL los chasis ya registrados se omiten y solo se devuelven los autos creados.
+    """
+    if not autos_data:
+        return []
+    try:
+        new_autos = await repository.create_many(autos_data)
+    except IntegrityError as e:
         raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Error al crear el auto (Verifique chasis único): {e}"
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Error al crear los autos (Verifique chasis únicos): {e.orig}"
         )
+    return new_autos
 
 # -------------------------------------------------------------------
-# GET /autos - Listar autos con paginación
+# GET /autos - Listar autos con paginación (keyset)
 # -------------------------------------------------------------------
 
-@router.get("/", response_model=List[AutoResponse])
-def read_all_autos(
-    skip: int = Query(0, ge=0), # Paginación: Índice de inicio
+@router.get("/", response_model=AutoPageResponse, response_class=ORJSONResponse)
+async def read_all_autos(
+    after_id: Optional[int] = Query(None, ge=0), # Paginación: ID del último auto recibido
     limit: int = Query(100, gt=0, le=100), # Paginación: Cantidad de registros
+    skip: Optional[int] = Query(None, ge=0, deprecated=True), # Obsoleto: usar after_id
+    repository: AutoRepository = Depends(get_auto_repository)
+):
+    """
+    Obtiene la lista de todos los Autos registrados con paginación por cursor.
+    Para pedir la página siguiente se envía 'next_cursor' como 'after_id'.
+    """
+    autos = await repository.get_all(after_id=after_id, limit=limit, skip=skip)
+    return {"items": autos, "next_cursor": autos[-1].id if autos else None}
+
+# -------------------------------------------------------------------
+# GET /autos/count - Cantidad total de autos
+# -------------------------------------------------------------------
+# Nota: Se declara antes de /{auto_id} para que "count" no se tome como un ID.
+# Los listados no cuentan filas: el total se pide solo cuando hace falta.
+
+@router.get("/count", response_model=AutoCountResponse)
+async def count_autos(
+    exact: bool = Query(False, description="Conteo exacto (COUNT(*)) en lugar de la estimación."),
     repository: AutoRepository = Depends(get_auto_repository)
 ):
     """
-    Obtiene la lista de todos los Autos registrados con paginación.
+    Devuelve la cantidad total de Autos. Por defecto es una estimación (sin recorrer la tabla).
     """
-    return repository.get_all(skip=skip, limit=limit)
+    if exact:
+        return {"count": await repository.count(), "exact": True}
+    return {"count": await repository.approx_count(), "exact": False}
+
+# -------------------------------------------------------------------
+# GET /autos/stream - Exportar autos en streaming (NDJSON)
+# -------------------------------------------------------------------
+# Nota: Se declara antes de /{auto_id} para que "stream" no se tome como un ID.
+
+@router.get("/stream")
+async def stream_autos(
+    after_id: Optional[int] = Query(None, ge=0), # Permite retomar la exportación por cursor
+    repository: AutoRepository = Depends(get_auto_repository)
+):
+    """
+    Exporta todos los Autos como NDJSON (un objeto JSON por línea), enviándolos
+    a medida que se leen de la base de datos.
+    """
+    async def generate():
+        async for auto in repository.stream_all(after_id=after_id):
+            # search_text es una columna interna de búsqueda, no forma parte de AutoResponse
+            yield orjson.dumps(auto.model_dump(exclude={"search_text"})) + b"\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
 
 # -------------------------------------------------------------------
 # GET /autos/{auto_id} - Obtener auto por ID (Respuesta simple)
 # -------------------------------------------------------------------
 
 @router.get("/{auto_id}", response_model=AutoResponse)
-def read_auto_by_id_simple(
+async def read_auto_by_id_simple(
     auto_id: int,
     repository: AutoRepository = Depends(get_auto_repository)
 ):
     """
     Obtiene un Auto específico por su ID.
     """
-    auto = repository.get_by_id(auto_id)
+    auto = await repository.get_by_id(auto_id)
     if not auto:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Auto con ID {auto_id} no encontrado"
-        )
+        return not_found(f"Auto con ID {auto_id} no encontrado")
     return auto
 
 # -------------------------------------------------------------------
@@ -85,7 +162,7 @@ def read_auto_by_id_simple(
 # -------------------------------------------------------------------
 
 @router.put("/{auto_id}", response_model=AutoResponse)
-def replace_auto(
+async def replace_auto(
     auto_id: int,
     auto_data: AutoCreate, # Usamos AutoCreate para asegurar que se envíen todos los campos
     repository: AutoRepository = Depends(get_auto_repository)
@@ -93,16 +170,18 @@ def replace_auto(
     """
     Actualiza completamente un Auto por su ID (PUT). Requiere todos los campos.
     """
-    # Convertimos AutoCreate a AutoUpdate para usar el método update del repositorio
-    auto_update_data = AutoUpdate.model_validate(auto_data.model_dump())
-    
-    updated_auto = repository.update(auto_id, auto_update_data)
-    
-    if not updated_auto:
+    # AutoCreate ya fue validado: se reemplaza directamente, sin re-validar como AutoUpdate
+    try:
+        updated_auto = await repository.replace(auto_id, auto_data)
+    except IntegrityError as e:
+        # Igual que al crear: la unicidad del chasis la garantiza la base de datos.
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Auto con ID {auto_id} no encontrado"
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Error al actualizar el auto (Verifique chasis único): {e.orig}"
         )
+    
+    if not updated_auto:
+        return not_found(f"Auto con ID {auto_id} no encontrado")
     return updated_auto
 
 # -------------------------------------------------------------------
@@ -110,19 +189,19 @@ def replace_auto(
 # -------------------------------------------------------------------
 
 @router.delete("/{auto_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_auto(
+async def delete_auto(
     auto_id: int,
     repository: AutoRepository = Depends(get_auto_repository)
 ):
     """
     Elimina un Auto por su ID.
     """
-    success = repository.delete(auto_id)
+    success = await repository.delete(auto_id)
     if not success:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Auto con ID {auto_id} no encontrado"
-        )
+        return not_found(f"Auto con ID {auto_id} no encontrado")
+    # Al borrar el auto sus ventas quedan sin auto_id: /ventas/auto/{auto_id} debe pasar a 404.
+    # Altas y reemplazos de autos no afectan las lecturas cacheadas (no incluyen campos del auto).
+    await invalidate_ventas_cache()
     return 
 
 # -------------------------------------------------------------------
@@ -130,19 +209,16 @@ def delete_auto(
 # -------------------------------------------------------------------
 # Nota: La ruta debe ser específica para evitar conflictos con /{auto_id}
 @router.get("/chasis/{numero_chasis}", response_model=AutoResponse)
-def read_auto_by_chasis(
+async def read_auto_by_chasis(
     numero_chasis: str,
     repository: AutoRepository = Depends(get_auto_repository)
 ):
     """
     Busca un Auto por su número de chasis único.
     """
-    auto = repository.get_by_chasis(numero_chasis)
+    auto = await repository.get_by_chasis(numero_chasis)
     if not auto:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Auto con chasis {numero_chasis} no encontrado"
-        )
+        return not_found(f"Auto con chasis {numero_chasis} no encontrado")
     return auto
 
 # -------------------------------------------------------------------
@@ -152,20 +228,17 @@ def read_auto_by_chasis(
 # con la ruta simple GET /{auto_id}.
 
 @router.get("/{auto_id}/with-ventas", response_model=AutoResponseWithVentas)
-def read_auto_with_ventas(
+async def read_auto_with_ventas(
     auto_id: int,
     repository: AutoRepository = Depends(get_auto_repository)
 ):
     """
     Obtiene un Auto específico por su ID, incluyendo el historial de Ventas asociadas.
     """
-    auto = repository.get_by_id(auto_id)
+    # Auto y ventas se obtienen juntos (selectinload), sin cargas perezosas posteriores.
+    auto = await repository.get_by_id_with_ventas(auto_id)
     if not auto:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Auto con ID {auto_id} no encontrado"
-        )
-    # Gracias a la relación definida en models.py, 'auto' ya incluye la lista de 'ventas'.
+        return not_found(f"Auto con ID {auto_id} no encontrado")
     return auto
 
 # -------------------------------------------------------------------
@@ -173,7 +246,7 @@ def read_auto_with_ventas(
 # -------------------------------------------------------------------
 
 @router.get("marcaomodelo/search", response_model=List[AutoResponse])
-def search_autos(
+async def search_autos(
     query: str = Query(..., description="Cadena de búsqueda para Marca o Modelo."),
     skip: int = Query(0, ge=0),
     limit: int = Query(100, gt=0, le=100),
@@ -185,4 +258,4 @@ def search_autos(
     if not query.strip():
         raise HTTPException(status_code=400, detail="La consulta no puede estar vacía.")
         
-    return repository.search_by_brand_or_model(query, skip=skip, limit=limit)
+    return await repository.search_by_brand_or_model(query, skip=skip, limit=limit)
@@ -1,7 +1,13 @@
-import os
-from typing import Generator
+from functools import lru_cache
+from typing import AsyncGenerator, Optional
 
-from sqlmodel import Session, create_engine, SQLModel
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from sqlalchemy import event, text
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
 from sqlmodel.sql.expression import Select, SelectOfScalar
 
 # Deshabilita una advertencia común de SQLModel/SQLAlchemy
@@ -12,54 +18,149 @@ Select.inherit_cache = True
 # Configuración del Motor
 # -------------------------------------------------------------------
 
-# Leer variables de entorno
-POSTGRES_USER = os.environ.get("POSTGRES_USER")
-POSTGRES_PASSWORD = os.environ.get("POSTGRES_PASSWORD")
-POSTGRES_SERVER = os.environ.get("POSTGRES_SERVER")
-POSTGRES_PORT = os.environ.get("POSTGRES_PORT")
-POSTGRES_DB = os.environ.get("POSTGRES_DB")
-# Construcción de la URL de conexión
-# Nota: Utilizamos 'postgresql' (psycopg2)
-DATABASE_URLV = (
-    f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@"
-    f"{POSTGRES_SERVER}:{POSTGRES_PORT}/{POSTGRES_DB}"
+class Settings(BaseSettings):
+    """
+    Configuración de la aplicación leída desde variables de entorno (o '.env').
+    """
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+
+    # "development" habilita el logging de SQL (echo); cualquier otro valor lo desactiva
+    ENVIRONMENT: str = "development"
+
+    DATABASE_URL: Optional[str] = None
+    POSTGRES_USER: Optional[str] = None
+    POSTGRES_PASSWORD: Optional[str] = None
+    POSTGRES_SERVER: Optional[str] = None
+    POSTGRES_PORT: Optional[str] = None
+    POSTGRES_DB: Optional[str] = None
+
+    # Pool de conexiones (por proceso/worker de uvicorn)
+    DB_POOL_SIZE: int = 25
+    DB_MAX_OVERFLOW: int = 25
+    # Recicla conexiones antiguas en lugar de hacer un "SELECT 1" (pre-ping) en cada checkout
+    DB_POOL_RECYCLE: int = 1800
+    # Solo habilitar si la red corta conexiones inactivas antes de DB_POOL_RECYCLE
+    DB_POOL_PRE_PING: bool = False
+
+    # Caché de respuestas: si no se define se usa una caché en memoria por proceso
+    REDIS_URL: Optional[str] = None
+
+    @property
+    def database_url(self) -> Optional[str]:
+        """URL de conexión: DATABASE_URL o, si no existe, la construida con POSTGRES_*."""
+        if self.DATABASE_URL:
+            return self.DATABASE_URL
+        if self.POSTGRES_USER and self.POSTGRES_SERVER and self.POSTGRES_DB:
+            # Nota: El driver se adapta luego a su versión asíncrona (asyncpg)
+            return (
+                f"postgresql://{self.POSTGRES_USER}:{self.POSTGRES_PASSWORD}@"
+                f"{self.POSTGRES_SERVER}:{self.POSTGRES_PORT or 5432}/{self.POSTGRES_DB}"
+            )
+        return None
+
+
+@lru_cache
+def get_settings() -> Settings:
+    """Devuelve la configuración, leyendo el entorno una única vez por proceso."""
+    return Settings()
+
+
+settings = get_settings()
+
+
+def to_async_url(url: str) -> URL:
+    """
+    Adapta la URL de conexión a un driver asíncrono.
+    Permite seguir usando 'postgresql://...' o 'sqlite:///...' en las variables de entorno.
+    """
+    url_obj = make_url(url)
+    backend = url_obj.get_backend_name()
+    if backend == "postgresql":
+        return url_obj.set(drivername="postgresql+asyncpg")
+    if backend == "sqlite":
+        return url_obj.set(drivername="sqlite+aiosqlite")
+    return url_obj
+
+
+def engine_options(url: URL) -> dict:
+    """Opciones del pool de conexiones según el backend de la URL."""
+    if url.get_backend_name() == "sqlite":
+        options = {"connect_args": {"check_same_thread": False}}
+        if url.database in (None, "", ":memory:"):
+            # Una base en memoria solo existe dentro de su conexión: se comparte una sola
+            options["poolclass"] = StaticPool
+        return options
+
+    return {
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+    }
+
+
+ENGINE_URL = to_async_url(settings.database_url or "sqlite:///./local_temp.db")
+
+# El motor debe ser global y creado solo una vez (un único pool por proceso).
+# El logging de SQL (echo) solo se activa en desarrollo: formatear cada sentencia
+# tiene un costo en cada consulta.
+engine = create_async_engine(
+    ENGINE_URL,
+    echo=settings.ENVIRONMENT == "development",
+    **engine_options(ENGINE_URL),
 )
 
-DATABASE_URL = os.environ.get("DATABASE_URL") 
+if ENGINE_URL.get_backend_name() == "sqlite":
+    @event.listens_for(engine.sync_engine, "connect")
+    def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+        """SQLite no valida las claves foráneas salvo que se active por conexión."""
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
 
-# El motor debe ser global y creado solo una vez
-# echo=True para logging SQL en desarrollo
-engine = create_engine(DATABASE_URL or DATABASE_URLV or "sqlite:///./local_temp.db", echo=True)
+# Fábrica de sesiones asíncronas.
+# expire_on_commit=False evita que los objetos se "expiren" tras el commit,
+# lo que en modo asíncrono provocaría una consulta implícita al serializarlos.
+# Por eso los repositorios no necesitan refresh() después de crear o actualizar.
+async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
 
 # -------------------------------------------------------------------
 # Funciones de Base de Datos
 # -------------------------------------------------------------------
 
-def create_db_and_tables():
+async def create_db_and_tables():
     """
-    Crea el motor y luego las tablas.
+    Crea las tablas usando el motor asíncrono.
     Esta función se llama durante el 'lifespan' de FastAPI.
     """
-    global engine
-
-    if not DATABASE_URL and not DATABASE_URLV:
+    if not settings.database_url:
         # Esto solo debería suceder si ejecutas fuera de Docker y sin variables de entorno
         print("ADVERTENCIA: DATABASE_URL no encontrada. Usando SQLite local.")
-        # No es necesario crear el motor aquí si se crea arriba, pero es un buen patrón
-        # para re-crear la conexión si fuera necesario.
 
     print("Intentando crear tablas en la base de datos...")
-    
-    # Esta línea ahora usa el motor creado. Si la URL era inválida, el fallo ocurrirá aquí.
-    SQLModel.metadata.create_all(engine)
+
+    # create_all es síncrono, por eso se ejecuta con run_sync sobre la conexión asíncrona.
+    # Si la URL era inválida, el fallo ocurrirá aquí.
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
     print("Tablas verificadas/creadas exitosamente.")
 
 
-def get_session() -> Generator[Session, None, None]:
+async def check_db_connection():
+    """
+    Verifica que la base de datos responda (una única consulta).
+    Se usa al iniciar fuera de desarrollo, donde el esquema no se crea desde la app.
+    """
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+    print("Conexión a la base de datos verificada.")
+
+
+async def get_session() -> AsyncGenerator[AsyncSession, None]:
     """
-    Patrón de generador (Dependencia de FastAPI) para obtener una sesión.
+    Patrón de generador (Dependencia de FastAPI) para obtener una sesión asíncrona.
     Abre una sesión y asegura que se cierre automáticamente.
     """
-    with Session(engine) as session:
-        yield session
\ No newline at end of file
+    async with async_session() as session:
+        yield session
@@ -1,13 +1,25 @@
+from datetime import datetime, timezone
+
 from dotenv import load_dotenv
 from fastapi import FastAPI
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.inmemory import InMemoryBackend
+from fastapi_cache.backends.redis import RedisBackend
+from redis import asyncio as aioredis
+from starlette.types import ASGIApp, Receive, Scope, Send
 from contextlib import asynccontextmanager
 
 # --- Cargar Variables de Entorno al inicio ---
 # Debe llamarse antes de importar cualquier módulo que dependa de ellas
 load_dotenv()
 
-# Importar la función de creación de tablas
-from database import create_db_and_tables
+# Importar las funciones de inicialización, el motor y la configuración
+from database import check_db_connection, create_db_and_tables, engine, settings
+
+# Hora por petición usada por los modelos
+from models import REQUEST_NOW
 
 # Importar los Routers
 from autos import router as autos_router
@@ -20,12 +32,24 @@ async def lifespan(app: FastAPI):
     """
     # --- Startup ---
     print("Aplicación iniciando...")
-    # Creamos las tablas en la base de datos si no existen
-    create_db_and_tables()
+    if settings.ENVIRONMENT == "development":
+        # En desarrollo creamos las tablas en la base de datos si no existen
+        await create_db_and_tables()
+    else:
+        # En otros entornos el esquema se gestiona en el despliegue;
+        # solo comprobamos la conexión para no inspeccionar el esquema en cada worker.
+        await check_db_connection()
+
+    # Caché de respuestas de las lecturas: compartida en Redis si está configurado
+    redis = aioredis.from_url(settings.REDIS_URL) if settings.REDIS_URL else None
+    FastAPICache.init(RedisBackend(redis) if redis else InMemoryBackend(), prefix="ventas-api")
     yield
     # --- Shutdown ---
     print("Aplicación cerrando...")
-    # Aquí podrías añadir cualquier lógica de limpieza si fuera necesaria
+    if redis:
+        await redis.close()
+    # Cerramos las conexiones del pool del motor asíncrono
+    await engine.dispose()
 
 
 # --- Inicialización de FastAPI ---
@@ -34,10 +58,39 @@ app = FastAPI(
     title="API de Gestión de Autos y Ventas",
     version="1.0.0",
     description="API RESTful construida con FastAPI y SQLModel para gestionar un inventario de vehículos y su historial de ventas.",
-    lifespan=lifespan # Usamos la función de ciclo de vida
+    lifespan=lifespan, # Usamos la función de ciclo de vida
+    default_response_class=ORJSONResponse # Serialización JSON con orjson (implementada en C/Rust)
 )
 
 
+# --- Middlewares ---
+
+# Comprime con gzip las respuestas de más de 1 KB (p. ej. los listados)
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+class RequestTimeMiddleware:
+    """
+    Marca la hora (UTC) de la petición una sola vez. Los validadores de fecha la
+    reutilizan, por ejemplo al crear muchas ventas en una misma petición.
+    Es un middleware ASGI puro: @app.middleware("http") (BaseHTTPMiddleware) agregaría
+    a cada petición un costo mucho mayor que la lectura del reloj que ahorra.
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = REQUEST_NOW.set(datetime.now(timezone.utc))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            REQUEST_NOW.reset(token)
+
+app.add_middleware(RequestTimeMiddleware)
+
+
 # --- Inclusión de Routers ---
 
 app.include_router(autos_router)
@@ -1,16 +1,50 @@
+from contextvars import ContextVar
 from datetime import datetime, timezone
 from typing import List, Optional
-import re
 
 # Importamos las clases necesarias de SQLModel, incluyendo el validador
 from sqlmodel import Field, Relationship, SQLModel
 
 from pydantic import field_validator
+from sqlalchemy import DDL, Column, Computed, DateTime, Index, Text, event, func, literal_column, text
+# Registra el dialecto de PostgreSQL antes de construir las expresiones full-text del módulo
+import sqlalchemy.dialects.postgresql  # noqa: F401
 
 
 # Obtener el año actual una sola vez para la validación de 'Auto'
 CURRENT_YEAR = datetime.now(timezone.utc).year
 
+# Hora de la petición en curso (UTC), marcada una sola vez por un middleware en main.py.
+# Valores por defecto y validadores la reutilizan en lugar de consultar el reloj cada vez.
+REQUEST_NOW: ContextVar[Optional[datetime]] = ContextVar("REQUEST_NOW", default=None)
+
+
+def now_utc() -> datetime:
+    """Hora actual en UTC; dentro de una petición devuelve la marcada por el middleware."""
+    return REQUEST_NOW.get() or datetime.now(timezone.utc)
+
+
+def _validate_not_future(v: datetime) -> datetime:
+    """Normaliza la fecha a UTC-aware y asegura que no sea en el futuro."""
+    # Si la fecha que Pydantic devuelve de la deserialización es naive,
+    # la forzamos a ser UTC-aware para la comparación.
+    if v.tzinfo is None:
+        v = v.replace(tzinfo=timezone.utc)
+
+    # Camino rápido: comparar contra la hora ya marcada para la petición. Solo si la
+    # supera se consulta el reloj real (otra petición pudo crear la venta después).
+    if v > now_utc() and v > datetime.now(timezone.utc):
+        raise ValueError("La fecha de venta no puede ser en el futuro.")
+    return v
+
+
+# La extensión pg_trgm debe existir antes de crear los índices de trigramas
+event.listen(
+    SQLModel.metadata,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"),
+)
+
 
 # ====================================================================
 # --- Modelos de Venta (Many side) ---
@@ -20,33 +54,49 @@ CURRENT_YEAR = datetime.now(timezone.utc).year
 class VentaBase(SQLModel):
     nombre_comprador: str = Field(min_length=1, description="El nombre del comprador no puede estar vacío.")
     precio: float = Field(gt=0, description="El precio de venta debe ser mayor a 0.")
-    # Clave foránea que enlaza esta Venta con el Auto
-    auto_id: Optional[int] = Field(default=None, foreign_key="auto.id")
-    # Usamos UTC por defecto para la consistencia
-    fecha_venta: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    # Clave foránea que enlaza esta Venta con el Auto.
+    # PostgreSQL no indexa automáticamente las FK: el índice acelera las ventas de un auto.
+    auto_id: Optional[int] = Field(default=None, foreign_key="auto.id", index=True)
+    # Usamos UTC por defecto para la consistencia (columna con zona horaria)
+    fecha_venta: datetime = Field(default_factory=now_utc, sa_type=DateTime(timezone=True))
 
     # Validador para asegurar que la fecha no sea futura
     @field_validator("fecha_venta", mode='after')
     @classmethod
     def validate_fecha_venta_not_future(cls, v):
         """Asegura que la fecha de venta no sea en el futuro."""
-        
-        # Si la fecha que Pydantic devuelve de la deserialización es naive,
-        # la forzamos a ser UTC-aware para la comparación.
-        if v.tzinfo is None:
-            v = v.replace(tzinfo=timezone.utc)
-        
-        # Validamos que no sea futura
-        if v and v > datetime.now(timezone.utc):
-            raise ValueError("La fecha de venta no puede ser en el futuro.")
-        return v
+        return _validate_not_future(v)
 
 # Venta: Modelo de tabla ORM
 class Venta(VentaBase, table=True):
+    # Índices compuestos para los filtros por rango: sirven tanto al WHERE como al
+    # ORDER BY (columna, id) de la paginación por cursor.
+    __table_args__ = (
+        Index("ix_venta_precio_id", "precio", "id"),
+        Index("ix_venta_fecha_venta_id", "fecha_venta", "id"),
+        # Índice GIN full-text del comprador (misma expresión que COMPRADOR_TSVECTOR)
+        Index(
+            "ix_venta_comprador_tsv",
+            text("to_tsvector('simple'::regconfig, nombre_comprador)"),
+            postgresql_using="gin",
+        ).ddl_if(dialect="postgresql"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
+    # Última modificación (solo en la tabla, no se expone en las respuestas): es la versión
+    # de la fila para el ETag. El default/onupdate de la columna cubre también los INSERT/UPDATE masivos.
+    updated_at: Optional[datetime] = Field(
+        default_factory=now_utc,
+        sa_type=DateTime(timezone=True),
+        sa_column_kwargs={"default": now_utc, "onupdate": now_utc},
+    )
     # Relación de vuelta al Auto (Many-to-One)
     auto: Optional["Auto"] = Relationship(back_populates="ventas")
 
+# Vector de búsqueda full-text del comprador (PostgreSQL). Es la misma expresión del
+# índice ix_venta_comprador_tsv, para que el planificador pueda usar el índice.
+COMPRADOR_TSVECTOR = func.to_tsvector(literal_column("'simple'::regconfig"), Venta.nombre_comprador)
+
 # VentaResponse: Modelo para respuestas de API (incluye ID)
 class VentaResponse(VentaBase):
     id: int
@@ -66,12 +116,9 @@ class VentaUpdate(SQLModel):
     @field_validator("fecha_venta", mode='after')
     @classmethod
     def validate_fecha_venta_not_future_update(cls, v):
-        if v.tzinfo is None:
-            v = v.replace(tzinfo=timezone.utc)
-        
-        if v and v > datetime.now(timezone.utc):
-            raise ValueError("La fecha de venta no puede ser en el futuro.")
-        return v
+        if v is None:
+            return v
+        return _validate_not_future(v)
 
 
 # ====================================================================
@@ -82,23 +129,49 @@ class VentaUpdate(SQLModel):
 class AutoBase(SQLModel):
     marca: str
     modelo: str
-    # Validación: Único en la base de datos
-    numero_chasis: str = Field(unique=True, index=True)
+    # Validación: Único en la base de datos (índice único definido en Auto.__table_args__)
+    numero_chasis: str
     # Validación: Año entre 1900 y año actual
     año: int = Field(ge=1900, le=CURRENT_YEAR)
 
     # Validador para numero_chasis (alfanumérico)
-    @field_validator("numero_chasis", mode='before')
+    # mode='after': Pydantic ya garantizó que v es str, no hace falta comprobar el tipo
+    @field_validator("numero_chasis", mode='after')
     @classmethod
-    def validate_chasis_alphanumeric(cls, v):
+    def validate_chasis_alphanumeric(cls, v: str) -> str:
         """Asegura que el número de chasis sea estrictamente alfanumérico (letras o números)."""
-        if not isinstance(v, str) or not re.fullmatch(r"^[a-zA-Z0-9]+$", v):
+        # isascii() + isalnum() equivale a ^[a-zA-Z0-9]+$ sin invocar el motor de regex
+        if not (v.isascii() and v.isalnum()):
             raise ValueError("El número de chasis debe ser estrictamente alfanumérico (sin espacios ni símbolos).")
         return v
 
 # Auto: Modelo de tabla ORM
 class Auto(AutoBase, table=True):
+    # Índice único sobre numero_chasis que además "cubre" el resto de las columnas
+    # (INCLUDE en PostgreSQL): la búsqueda por chasis se resuelve con un index-only scan.
+    __table_args__ = (
+        Index(
+            "ix_auto_chasis_covering",
+            "numero_chasis",
+            unique=True,
+            postgresql_include=["marca", "modelo", "año", "id"],
+        ),
+        # Índice GIN de trigramas (pg_trgm) sobre search_text: permite usar índice en ILIKE '%texto%'
+        Index(
+            "ix_auto_search_trgm",
+            "search_text",
+            postgresql_using="gin",
+            postgresql_ops={"search_text": "gin_trgm_ops"},
+        ).ddl_if(dialect="postgresql"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
+    # Marca y modelo concatenados, calculados por la base de datos (columna generada, solo lectura).
+    # La búsqueda por marca o modelo consulta esta única columna con un único índice.
+    search_text: Optional[str] = Field(
+        default=None,
+        sa_column=Column(Text, Computed("coalesce(marca, '') || ' ' || coalesce(modelo, '')", persisted=True)),
+    )
     # Relación One-to-Many con Venta
     ventas: List[Venta] = Relationship(back_populates="auto")
 
@@ -118,10 +191,10 @@ class AutoUpdate(SQLModel):
     año: Optional[int] = Field(default=None, ge=1900, le=CURRENT_YEAR)
 
     # Reutilizamos la lógica del validador para el chasis en la actualización
-    @field_validator("numero_chasis", mode='before')
+    @field_validator("numero_chasis", mode='after')
     @classmethod
-    def validate_chasis_alphanumeric_update(cls, v):
-        if v and not re.fullmatch(r"^[a-zA-Z0-9]+$", v):
+    def validate_chasis_alphanumeric_update(cls, v: Optional[str]) -> Optional[str]:
+        if v and not (v.isascii() and v.isalnum()):
             raise ValueError("El número de chasis debe ser estrictamente alfanumérico (sin espacios ni símbolos).")
         return v
 
@@ -136,4 +209,28 @@ class AutoResponseWithVentas(AutoResponse):
 
 # VentaResponseWithAuto: Incluye la información del Auto asociado
 class VentaResponseWithAuto(VentaResponse):
-    auto: Optional[AutoResponse] = None # Usamos AutoResponse para la anidación
\ No newline at end of file
+    auto: Optional[AutoResponse] = None # Usamos AutoResponse para la anidación
+
+
+# AutoCountResponse: Cantidad total de autos
+class AutoCountResponse(SQLModel):
+    count: int
+    # False cuando el valor es una estimación de las estadísticas de la base de datos
+    exact: bool
+
+
+# ====================================================================
+# --- Modelos de Respuesta Paginada (Keyset) ---
+# ====================================================================
+
+# AutoPageResponse: Página de autos con el cursor para pedir la siguiente
+class AutoPageResponse(SQLModel):
+    items: List[AutoResponse] = []
+    # ID del último auto de la página; se envía como 'after_id' para la siguiente
+    next_cursor: Optional[int] = None
+
+# VentaPageResponse: Página de ventas con el cursor para pedir la siguiente
+class VentaPageResponse(SQLModel):
+    items: List[VentaResponse] = []
+    # ID de la última venta de la página; se envía como 'after_id' para la siguiente
+    next_cursor: Optional[int] = None
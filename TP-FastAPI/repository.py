@@ -1,9 +1,17 @@
+import re
 from datetime import datetime
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional
 
-from sqlmodel import Session, or_, select
+from cachetools import TTLCache
+from sqlalchemy import Integer, bindparam, func, insert, literal, literal_column, text, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import defer, joinedload, selectinload
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from models import (
+    COMPRADOR_TSVECTOR,
     Auto,
     AutoCreate,
     AutoUpdate,
@@ -13,195 +21,436 @@ from models import (
 )
 
 
+# -------------------------------------------------------------------
+# Sentencias reutilizables
+# -------------------------------------------------------------------
+# Se construyen una sola vez con parámetros enlazados (bindparam): SQLAlchemy
+# reutiliza su forma compilada desde la caché en cada ejecución.
+
+# search_text no está en el INCLUDE del índice de chasis: se difiere para mantener el index-only scan
+_STMT_BY_CHASIS = (
+    select(Auto)
+    .where(Auto.numero_chasis == bindparam("chasis"))
+    .options(defer(Auto.search_text))
+    .limit(1)
+)
+
+_STMT_AUTO_EXISTS = select(literal(1)).where(Auto.id == bindparam("auto_id")).limit(1)
+
+# Las búsquedas de ventas paginan por cursor: 'after_id' = 0 equivale a "desde el inicio",
+# ya que los IDs autoincrementales empiezan en 1.
+_STMT_VENTA_BY_AUTO_ID = (
+    select(Venta)
+    .where(Venta.auto_id == bindparam("auto_id"), Venta.id > bindparam("after_id"))
+    .order_by(Venta.id)
+    .limit(bindparam("limit", type_=Integer))
+)
+
+# Búsqueda full-text del comprador (PostgreSQL, usa el índice GIN)
+_STMT_VENTA_BY_COMPRADOR_FTS = (
+    select(Venta)
+    .where(
+        COMPRADOR_TSVECTOR.op("@@")(
+            func.to_tsquery(literal_column("'simple'::regconfig"), bindparam("nombre"))
+        ),
+        Venta.id > bindparam("after_id"),
+    )
+    .order_by(Venta.id)
+    .limit(bindparam("limit", type_=Integer))
+)
+
+def _prefix_tsquery(nombre: str) -> str:
+    """
+    Convierte el texto en una tsquery por prefijo ('jua per' -> 'jua:* & per:*'), para que
+    "Jua" encuentre a "Juan". Solo se conservan las palabras: los operadores de tsquery se descartan.
+    """
+    return " & ".join(f"{palabra}:*" for palabra in re.findall(r"\w+", nombre))
+
+# Búsqueda del comprador con LIKE %nombre% (otros motores, p. ej. SQLite)
+_STMT_VENTA_BY_COMPRADOR_LIKE = (
+    select(Venta)
+    .where(Venta.nombre_comprador.contains(bindparam("nombre")), Venta.id > bindparam("after_id"))
+    .order_by(Venta.id)
+    .limit(bindparam("limit", type_=Integer))
+)
+
+
+# -------------------------------------------------------------------
+# Cachés en memoria (por proceso)
+# -------------------------------------------------------------------
+# IDs de autos que se sabe que existen. Solo se guardan resultados positivos:
+# un auto creado después nunca queda "oculto" por un negativo cacheado.
+_AUTO_EXISTS_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+# Conteo exacto de autos (COUNT(*) recorre toda la tabla): se reutiliza durante 30 segundos.
+_AUTO_COUNT_CACHE: TTLCache = TTLCache(maxsize=1, ttl=30)
+
+
 class AutoRepository:
     """
     Clase Repository para manejar las operaciones CRUD y búsquedas de la entidad Auto.
     """
-    def __init__(self, session: Session):
+    def __init__(self, session: AsyncSession):
         """Inicializa el repositorio con la sesión de la base de datos."""
         self.session = session
 
     # Crear
-    def create(self, auto_data: AutoCreate) -> Auto:
+    async def create(self, auto_data: AutoCreate) -> Auto:
         """Crea un nuevo Auto en la base de datos."""
-        db_auto = Auto.model_validate(auto_data)
+        # AutoCreate ya fue validado: los modelos tabla de SQLModel no re-validan en __init__
+        db_auto = Auto(**auto_data.model_dump())
         self.session.add(db_auto)
-        self.session.commit()
-        self.session.refresh(db_auto)
+        await self.session.commit()
         return db_auto
 
+    # Crear varios en lote
+    async def create_many(self, autos_data: List[AutoCreate]) -> List[Auto]:
+        """
+        Crea varios Autos con INSERT ... RETURNING multi-fila en una sola transacción.
+        En PostgreSQL los chasis ya existentes se omiten (ON CONFLICT DO NOTHING): la carga
+        es idempotente y solo se devuelven los autos efectivamente creados.
+        """
+        rows = [auto.model_dump() for auto in autos_data]
+        if self.session.bind.dialect.name == "postgresql":
+            statement = pg_insert(Auto).on_conflict_do_nothing(index_elements=["numero_chasis"])
+        else:
+            statement = insert(Auto)
+        # Las filas se pasan como parámetros (no en .values()): SQLAlchemy las agrupa en
+        # lotes de INSERT multi-fila sin superar el límite de parámetros por sentencia del driver.
+        autos = (await self.session.scalars(statement.returning(Auto), rows)).all()
+        await self.session.commit()
+        return autos
+
     # Obtener por ID
-    def get_by_id(self, auto_id: int) -> Optional[Auto]:
+    async def get_by_id(self, auto_id: int) -> Optional[Auto]:
         """Obtiene un Auto por su ID."""
-        auto = self.session.get(Auto, auto_id)
+        auto = await self.session.get(Auto, auto_id)
         return auto
 
-    # Obtener todos con paginación
-    def get_all(self, skip: int = 0, limit: int = 100) -> List[Auto]:
-        """Obtiene una lista de Autos con paginación (skip y limit)."""
-        # Añadimos .offset(skip) y .limit(limit) para la paginación
-        statement = select(Auto).offset(skip).limit(limit)
-        autos = self.session.exec(statement).all()
+    # Verificar existencia
+    async def exists(self, auto_id: int) -> bool:
+        """
+        Indica si existe un Auto con ese ID usando SELECT 1 (sin materializar columnas).
+        Los resultados positivos se cachean durante 60 segundos.
+        """
+        if auto_id in _AUTO_EXISTS_CACHE:
+            return True
+        result = await self.session.exec(_STMT_AUTO_EXISTS, params={"auto_id": auto_id})
+        found = result.first() is not None
+        if found:
+            _AUTO_EXISTS_CACHE[auto_id] = True
+        return found
+
+    # Obtener por ID incluyendo sus ventas
+    async def get_by_id_with_ventas(self, auto_id: int) -> Optional[Auto]:
+        """
+        Obtiene un Auto por su ID con sus Ventas ya cargadas (selectinload).
+        Evita la carga perezosa de la relación al serializar la respuesta.
+        """
+        statement = select(Auto).where(Auto.id == auto_id).options(selectinload(Auto.ventas))
+        auto = (await self.session.exec(statement)).first()
+        return auto
+
+    # Obtener todos con paginación por cursor (keyset)
+    async def get_all(self, after_id: Optional[int] = None, limit: int = 100, skip: Optional[int] = None) -> List[Auto]:
+        """
+        Obtiene una lista de Autos con paginación keyset (after_id y limit).
+        Usa el índice de la clave primaria en lugar de OFFSET, por lo que el costo
+        no crece con la profundidad de la página.
+        'skip' (OFFSET) se mantiene solo por compatibilidad y está obsoleto.
+        """
+        statement = select(Auto).order_by(Auto.id).limit(limit)
+        if after_id is not None:
+            statement = statement.where(Auto.id > after_id)
+        elif skip:
+            statement = statement.offset(skip)
+        autos = (await self.session.exec(statement)).all()
         return autos
 
+    # Conteo exacto
+    async def count(self) -> int:
+        """Cantidad exacta de Autos (SELECT COUNT(*)), cacheada durante 30 segundos."""
+        total = _AUTO_COUNT_CACHE.get("total")
+        if total is None:
+            statement = select(func.count()).select_from(Auto)
+            total = (await self.session.exec(statement)).one()
+            _AUTO_COUNT_CACHE["total"] = total
+        return total
+
+    # Conteo aproximado
+    async def approx_count(self) -> int:
+        """
+        Cantidad aproximada de Autos según las estadísticas de PostgreSQL (pg_class.reltuples),
+        sin recorrer la tabla. Si no hay estadísticas o el motor no es PostgreSQL, usa count().
+        """
+        if self.session.bind.dialect.name == "postgresql":
+            statement = text("SELECT reltuples::bigint FROM pg_class WHERE relname = 'auto'")
+            estimate = (await self.session.exec(statement)).scalar()
+            # reltuples es -1 mientras la tabla no haya sido analizada
+            if estimate is not None and estimate >= 0:
+                return estimate
+        return await self.count()
+
+    # Recorrer todos en streaming
+    async def stream_all(self, after_id: Optional[int] = None) -> AsyncIterator[Auto]:
+        """
+        Recorre los Autos ordenados por ID trayéndolos de a lotes (yield_per),
+        sin cargar el resultado completo en memoria.
+        """
+        statement = select(Auto).order_by(Auto.id).execution_options(yield_per=500)
+        if after_id is not None:
+            statement = statement.where(Auto.id > after_id)
+        result = await self.session.stream_scalars(statement)
+        async for auto in result:
+            yield auto
+
     # Actualizar
-    def update(self, auto_id: int, auto_data: AutoUpdate) -> Optional[Auto]:
-        """Actualiza parcialmente un Auto (PATCH/PUT)."""
-        db_auto = self.session.get(Auto, auto_id)
+    async def update(self, auto_id: int, auto_data: AutoUpdate) -> Optional[Auto]:
+        """Actualiza parcialmente un Auto (PATCH/PUT) usando setattr."""
+        db_auto = await self.session.get(Auto, auto_id)
         if not db_auto:
             return None
 
-        # Obtiene los campos enviados por el cliente que no son None
-        update_data = auto_data.model_dump(exclude_unset=True)
-    
-        # Itera sobre los campos y valores que deben ser actualizados
-        for key, value in update_data.items():
+        # Itera solo sobre los campos enviados por el cliente (sin copiar a un dict)
+        for key in auto_data.model_fields_set:
             # Aplica el nuevo valor al objeto de la base de datos
-            setattr(db_auto, key, value)
-    
-        # NO es necesario usar model_validate aquí si usamos setattr
-        # La validación ocurrirá automáticamente al hacer db_auto = self.session.add(db_auto)
-    
+            setattr(db_auto, key, getattr(auto_data, key))
+
+        # No se re-valida con model_validate: AutoUpdate ya validó los campos y
+        # la base de datos aplica sus propias restricciones (p. ej. chasis único).
         self.session.add(db_auto)
-        self.session.commit()
-        self.session.refresh(db_auto)
+        await self.session.commit()
         return db_auto
 
+    # Reemplazar
+    async def replace(self, auto_id: int, auto_data: AutoCreate) -> Optional[Auto]:
+        """
+        Reemplaza todos los campos de un Auto (PUT) con un único UPDATE ... RETURNING.
+        Los datos ya llegan validados como AutoCreate.
+        Si el nuevo chasis ya existe, deshace la transacción y propaga el IntegrityError.
+        """
+        statement = (
+            update(Auto)
+            .where(Auto.id == auto_id)
+            .values(**auto_data.model_dump())
+            .returning(Auto)
+        )
+        try:
+            auto = (await self.session.exec(statement)).scalars().first()
+            await self.session.commit()
+        except IntegrityError:
+            await self.session.rollback()
+            raise
+        return auto
+
     # Eliminar
-    def delete(self, auto_id: int) -> bool:
+    async def delete(self, auto_id: int) -> bool:
         """Elimina un Auto por su ID."""
-        auto = self.session.get(Auto, auto_id)
+        auto = await self.session.get(Auto, auto_id)
         if auto:
-            self.session.delete(auto)
-            self.session.commit()
+            await self.session.delete(auto)
+            await self.session.commit()
+            _AUTO_EXISTS_CACHE.pop(auto_id, None)
             return True
         return False
     
     # Búsqueda específica
-    def get_by_chasis(self, numero_chasis: str) -> Optional[Auto]:
+    async def get_by_chasis(self, numero_chasis: str) -> Optional[Auto]:
         """Obtiene un Auto por su número de chasis único."""
-        statement = select(Auto).where(Auto.numero_chasis == numero_chasis)
-        auto = self.session.exec(statement).first()
+        auto = (await self.session.exec(_STMT_BY_CHASIS, params={"chasis": numero_chasis})).first()
         return auto
     
     # Búsqueda por Marca o Modelo
-    def search_by_brand_or_model(self, query: str, skip: int = 0, limit: int = 100) -> List[Auto]:
+    async def search_by_brand_or_model(self, query: str, skip: int = 0, limit: int = 100) -> List[Auto]:
         """
         Busca autos donde la marca o el modelo contengan la cadena de consulta.
+        Una consulta vacía devuelve [] sin ir a la base ('%%' coincidiría con todas las filas).
         """
+        if not query or not query.strip():
+            return []
         search_term = f"%{query}%"
-        
+
         statement = (
             select(Auto)
-            .where(
-                or_(
-                    Auto.marca.ilike(search_term),  # ilike es case-insensitive LIKE
-                    Auto.modelo.ilike(search_term)
-                )
-            )
+            # Una sola condición sobre la columna generada 'marca modelo' (en lugar de un OR
+            # entre dos columnas). ilike es case-insensitive LIKE: en PostgreSQL usa el índice
+            # GIN de trigramas; en otros motores SQLAlchemy lo traduce a lower(col) LIKE lower(?).
+            .where(Auto.search_text.ilike(search_term))
             .offset(skip)
             .limit(limit)
         )
-        return self.session.exec(statement).all()
+        return (await self.session.exec(statement)).all()
 
 
 class VentaRepository:
     """
     Clase Repository para manejar las operaciones CRUD y búsquedas de la entidad Venta.
     """
-    def __init__(self, session: Session):
+    def __init__(self, session: AsyncSession):
         self.session = session
 
     # Crear
-    def create(self, venta_data: VentaCreate) -> Venta:
+    async def create(self, venta_data: VentaCreate) -> Venta:
         """Crea una nueva Venta en la base de datos."""
-        db_venta = Venta.model_validate(venta_data)
+        # VentaCreate ya fue validado: los modelos tabla de SQLModel no re-validan en __init__
+        db_venta = Venta(**venta_data.model_dump())
         self.session.add(db_venta)
-        self.session.commit()
-        self.session.refresh(db_venta)
+        await self.session.commit()
         return db_venta
 
+    # Crear varias en lote
+    async def create_many(self, ventas_data: List[VentaCreate]) -> List[Venta]:
+        """
+        Crea varias Ventas con INSERT ... RETURNING multi-fila en una sola transacción.
+        Como en AutoRepository.create_many, las filas se pasan como parámetros para que
+        SQLAlchemy las agrupe en lotes.
+        """
+        rows = [venta.model_dump() for venta in ventas_data]
+        ventas = (await self.session.scalars(insert(Venta).returning(Venta), rows)).all()
+        await self.session.commit()
+        return ventas
+
     # Obtener por ID
-    def get_by_id(self, venta_id: int) -> Optional[Venta]:
+    async def get_by_id(self, venta_id: int) -> Optional[Venta]:
         """Obtiene una Venta por su ID."""
-        venta = self.session.get(Venta, venta_id)
+        venta = await self.session.get(Venta, venta_id)
+        return venta
+
+    # Obtener por ID incluyendo su auto
+    async def get_by_id_with_auto(self, venta_id: int) -> Optional[Venta]:
+        """
+        Obtiene una Venta por su ID con su Auto ya cargado.
+        Al ser una única fila Many-to-One, joinedload la trae en la misma consulta (JOIN).
+        """
+        statement = select(Venta).where(Venta.id == venta_id).options(joinedload(Venta.auto))
+        venta = (await self.session.exec(statement)).first()
         return venta
 
     # Obtener todos con paginación
-    def get_all(self, skip: int = 0, limit: int = 100) -> List[Venta]:
-        """Obtiene una lista de Ventas con paginación (skip y limit)."""
-        statement = select(Venta).offset(skip).limit(limit)
-        ventas = self.session.exec(statement).all()
+    async def get_all(self, after_id: Optional[int] = None, limit: int = 100, skip: Optional[int] = None) -> List[Venta]:
+        """
+        Obtiene una lista de Ventas con paginación keyset (after_id y limit).
+        'skip' (OFFSET) se mantiene solo por compatibilidad y está obsoleto.
+        """
+        statement = select(Venta).order_by(Venta.id).limit(limit)
+        if after_id is not None:
+            statement = statement.where(Venta.id > after_id)
+        elif skip:
+            statement = statement.offset(skip)
+        ventas = (await self.session.exec(statement)).all()
         return ventas
 
+    # Recorrer todas en streaming
+    async def stream_all(self, after_id: Optional[int] = None) -> AsyncIterator[Venta]:
+        """
+        Recorre las Ventas ordenadas por ID trayéndolas de a lotes (yield_per),
+        sin cargar el resultado completo en memoria.
+        """
+        statement = select(Venta).order_by(Venta.id).execution_options(yield_per=500)
+        if after_id is not None:
+            statement = statement.where(Venta.id > after_id)
+        result = await self.session.stream_scalars(statement)
+        async for venta in result:
+            yield venta
+
     # Actualizar
-    def update(self, venta_id: int, venta_data: VentaUpdate) -> Optional[Venta]:
+    async def update(self, venta_id: int, venta_data: VentaUpdate) -> Optional[Venta]:
         """Actualiza parcialmente una Venta (PATCH/PUT) usando setattr."""
-        db_venta = self.session.get(Venta, venta_id)
+        db_venta = await self.session.get(Venta, venta_id)
         if not db_venta:
             return None
 
-        # Obtiene los campos enviados por el cliente que no son None
-        update_data = venta_data.model_dump(exclude_unset=True)
-    
-        # Itera y aplica los nuevos valores al objeto de la base de datos
-        for key, value in update_data.items():
-            setattr(db_venta, key, value)
-    
+        # Itera solo sobre los campos enviados por el cliente (sin copiar a un dict)
+        for key in venta_data.model_fields_set:
+            setattr(db_venta, key, getattr(venta_data, key))
+
         self.session.add(db_venta)
-        self.session.commit()
-        self.session.refresh(db_venta)
+        await self.session.commit()
         return db_venta
 
     # Eliminar
-    def delete(self, venta_id: int) -> bool:
+    async def delete(self, venta_id: int) -> bool:
         """Elimina una Venta por su ID."""
-        venta = self.session.get(Venta, venta_id)
+        venta = await self.session.get(Venta, venta_id)
         if venta:
-            self.session.delete(venta)
-            self.session.commit()
+            await self.session.delete(venta)
+            await self.session.commit()
             return True
         return False
 
     # Búsqueda específica por Auto ID
-    def get_by_auto_id(self, auto_id: int) -> List[Venta]:
-        """Obtiene todas las Ventas asociadas a un Auto específico."""
-        statement = select(Venta).where(Venta.auto_id == auto_id)
-        ventas = self.session.exec(statement).all()
+    async def get_by_auto_id(self, auto_id: int, after_id: Optional[int] = None, limit: int = 100) -> List[Venta]:
+        """Obtiene las Ventas asociadas a un Auto específico, paginadas por cursor (after_id)."""
+        params = {"auto_id": auto_id, "after_id": after_id or 0, "limit": limit}
+        ventas = (await self.session.exec(_STMT_VENTA_BY_AUTO_ID, params=params)).all()
         return ventas
 
     # Búsqueda específica por Comprador
-    def get_by_comprador(self, nombre: str) -> List[Venta]:
+    async def get_by_comprador(self, nombre: str, after_id: Optional[int] = None, limit: int = 100) -> List[Venta]:
         """
-        Obtiene Ventas por el nombre del comprador (búsqueda parcial con LIKE).
+        Obtiene Ventas por el nombre del comprador, paginadas por cursor (after_id).
+        En PostgreSQL usa búsqueda full-text por prefijo de palabra (índice GIN): "Jua" encuentra
+        a "Juan Pérez", pero no un fragmento intermedio como "uan". En otros motores, LIKE %nombre%.
         """
-        # Usamos .contains() para un LIKE %nombre% en la base de datos
-        statement = select(Venta).where(Venta.nombre_comprador.contains(nombre))
-        ventas = self.session.exec(statement).all()
+        if self.session.bind.dialect.name == "postgresql":
+            nombre = _prefix_tsquery(nombre)
+            if not nombre:
+                return []
+            statement = _STMT_VENTA_BY_COMPRADOR_FTS
+        else:
+            statement = _STMT_VENTA_BY_COMPRADOR_LIKE
+        params = {"nombre": nombre, "after_id": after_id or 0, "limit": limit}
+        ventas = (await self.session.exec(statement, params=params)).all()
         return ventas
     
     # Filtrado por Rango de Precios
-    def filter_by_price_range(self, min_price: float, max_price: float, skip: int = 0, limit: int = 100) -> List[Venta]:
+    async def filter_by_price_range(
+        self,
+        min_price: float,
+        max_price: float,
+        after_precio: Optional[float] = None,
+        after_id: Optional[int] = None,
+        limit: int = 100,
+        skip: Optional[int] = None,
+    ) -> List[Venta]:
         """
-        Obtiene ventas dentro de un rango de precios (mínimo y máximo).
+        Obtiene ventas dentro de un rango de precios (mínimo y máximo), ordenadas por
+        (precio, id) y paginadas por cursor: la página siguiente empieza después del
+        par (after_precio, after_id) del último resultado recibido.
         """
         statement = (
             select(Venta)
             .where(Venta.precio >= min_price, Venta.precio <= max_price)
-            .offset(skip)
+            .order_by(Venta.precio, Venta.id)
             .limit(limit)
         )
-        return self.session.exec(statement).all()
+        if after_precio is not None and after_id is not None:
+            statement = statement.where(tuple_(Venta.precio, Venta.id) > tuple_(after_precio, after_id))
+        elif skip:
+            statement = statement.offset(skip)
+        return (await self.session.exec(statement)).all()
 
     # Filtrado por Rango de Fechas
-    def filter_by_date_range(self, start_date: datetime, end_date: datetime, skip: int = 0, limit: int = 100) -> List[Venta]:
+    async def filter_by_date_range(
+        self,
+        start_date: datetime,
+        end_date: datetime,
+        after_fecha: Optional[datetime] = None,
+        after_id: Optional[int] = None,
+        limit: int = 100,
+        skip: Optional[int] = None,
+    ) -> List[Venta]:
         """
-        Obtiene ventas realizadas entre dos fechas específicas (rango inclusivo).
+        Obtiene ventas realizadas entre dos fechas específicas (rango inclusivo),
+        ordenadas por (fecha_venta, id) y paginadas por cursor (after_fecha, after_id).
         """
         statement = (
             select(Venta)
             .where(Venta.fecha_venta >= start_date, Venta.fecha_venta <= end_date)
-            .offset(skip)
+            .order_by(Venta.fecha_venta, Venta.id)
             .limit(limit)
         )
-        return self.session.exec(statement).all()
\ No newline at end of file
+        if after_fecha is not None and after_id is not None:
+            statement = statement.where(tuple_(Venta.fecha_venta, Venta.id) > tuple_(after_fecha, after_id))
+        elif skip:
+            statement = statement.offset(skip)
+        return (await self.session.exec(statement)).all()
@@ -0,0 +1,29 @@
+import hashlib
+from urllib.parse import urlencode
+
+from fastapi import Request, Response
+from fastapi_cache import FastAPICache
+
+# -------------------------------------------------------------------
+# Caché de Respuestas de Ventas
+# -------------------------------------------------------------------
+# Backend (Redis o memoria) inicializado en el 'lifespan' de main.py.
+# Las escrituras vacían todo el namespace; el TTL corto acota lo desactualizado.
+
+VENTAS_CACHE_NAMESPACE = "ventas"
+VENTAS_CACHE_EXPIRE = 30  # segundos
+
+
+def ventas_cache_key(func, namespace: str = "", *, request: Request = None, response: Response = None, args=(), kwargs=None) -> str:
+    """
+    Clave de caché: hash de la ruta y de los parámetros de consulta ordenados, para que
+    el mismo pedido con los parámetros en otro orden use la misma entrada.
+    """
+    query = urlencode(sorted(request.query_params.multi_items()))
+    digest = hashlib.sha1(f"{request.url.path}?{query}".encode()).hexdigest()
+    return f"{namespace}:{digest}"
+
+
+async def invalidate_ventas_cache() -> None:
+    """Descarta las lecturas de ventas cacheadas tras una escritura."""
+    await FastAPICache.clear(namespace=VENTAS_CACHE_NAMESPACE)
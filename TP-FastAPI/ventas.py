@@ -1,13 +1,19 @@
-from datetime import datetime
-from typing import List
+from datetime import datetime, timezone
+from typing import List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, status, Query
-from sqlmodel import Session
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status, Query
+from fastapi.responses import StreamingResponse
+from fastapi_cache.decorator import cache
+from sqlalchemy.exc import IntegrityError
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from database import get_session
 from repository import AutoRepository, VentaRepository
+from response_cache import VENTAS_CACHE_EXPIRE, VENTAS_CACHE_NAMESPACE, invalidate_ventas_cache, ventas_cache_key
 from models import (
     VentaCreate,
+    VentaPageResponse,
     VentaResponse,
     VentaResponseWithAuto,
     VentaUpdate,
@@ -17,78 +23,173 @@ from models import (
 # -------------------------------------------------------------------
 # Configuración del Router y Dependencias
 # -------------------------------------------------------------------
+# Las dependencias son 'async def' para que FastAPI no las ejecute en el threadpool.
 
 router = APIRouter(prefix="/ventas", tags=["Ventas"])
 
-def get_auto_repository(session: Session = Depends(get_session)) -> AutoRepository:
+async def get_auto_repository(session: AsyncSession = Depends(get_session)) -> AutoRepository:
     """Provee una instancia del AutoRepository."""
     return AutoRepository(session)
 
-def get_venta_repository(session: Session = Depends(get_session)) -> VentaRepository:
+async def get_venta_repository(session: AsyncSession = Depends(get_session)) -> VentaRepository:
     """Provee una instancia del VentaRepository."""
     return VentaRepository(session)
 
+# Fechas en UTC con sufijo "Z" (también las naive que devuelve SQLite), igual que Pydantic
+# en el resto de los endpoints, al serializar directamente con orjson.
+ORJSON_DATETIME_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+
+# Código SQLSTATE de PostgreSQL para "foreign_key_violation"
+FOREIGN_KEY_VIOLATION = "23503"
+
+def is_foreign_key_violation(error: IntegrityError) -> bool:
+    """Indica si el IntegrityError se debe a una clave foránea inexistente."""
+    if getattr(error.orig, "pgcode", None) == FOREIGN_KEY_VIOLATION:
+        return True
+    # SQLite no expone SQLSTATE; se identifica por el mensaje
+    return "FOREIGN KEY constraint failed" in str(error.orig)
+
+def venta_etag(venta_id: int, updated_at: Optional[datetime]) -> str:
+    """ETag débil de una Venta, derivado de su última modificación."""
+    version = updated_at.timestamp() if updated_at else 0
+    return f'W/"{venta_id}-{version}"'
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    """Indica si el cliente ya tiene la versión actual (cabecera If-None-Match)."""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in (tag.strip() for tag in if_none_match.split(","))
+
 # -------------------------------------------------------------------
 # POST /ventas - Crear nueva venta
 # -------------------------------------------------------------------
 
 @router.post("/", response_model=VentaResponse, status_code=status.HTTP_201_CREATED)
-def create_venta(
+async def create_venta(
     venta_data: VentaCreate,
-    venta_repo: VentaRepository = Depends(get_venta_repository),
-    auto_repo: AutoRepository = Depends(get_auto_repository)
+    venta_repo: VentaRepository = Depends(get_venta_repository)
 ):
     """
-    Crea una nueva Venta, verificando que el auto asociado (auto_id) exista.
+    Crea una nueva Venta. La existencia del auto asociado (auto_id) la verifica
+    la clave foránea en la base de datos, sin una consulta previa.
     """
-    # Verificación de la clave foránea
-    if not auto_repo.get_by_id(venta_data.auto_id):
+    try:
+        new_venta = await venta_repo.create(venta_data)
+    except IntegrityError as e:
+        if is_foreign_key_violation(e):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Auto con ID {venta_data.auto_id} no encontrado. No se puede crear la venta."
+            )
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Auto con ID {venta_data.auto_id} no encontrado. No se puede crear la venta."
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Error al crear la venta: {e.orig}"
         )
+    await invalidate_ventas_cache()
+    return new_venta
+
+# -------------------------------------------------------------------
+# POST /ventas/bulk - Crear varias ventas en lote
+# -------------------------------------------------------------------
+
+@router.post("/bulk", response_model=List[VentaResponse], status_code=status.HTTP_201_CREATED)
+async def create_ventas_bulk(
+    ventas_data: List[VentaCreate],
+    venta_repo: VentaRepository = Depends(get_venta_repository)
+):
+    """
+    Crea varias Ventas en una sola transacción (INSERT multi-fila, en lotes).
+    Si algún auto_id no existe no se crea ninguna.
+    """
+    if not ventas_data:
+        return []
     try:
-        new_venta = venta_repo.create(venta_data)
-        return new_venta
-    except Exception as e:
+        new_ventas = await venta_repo.create_many(ventas_data)
+    except IntegrityError as e:
+        if is_foreign_key_violation(e):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Alguno de los autos indicados (auto_id) no existe. No se creó ninguna venta."
+            )
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Error al crear la venta: {e}"
+            detail=f"Error al crear las ventas: {e.orig}"
         )
+    await invalidate_ventas_cache()
+    return new_ventas
 
 # -------------------------------------------------------------------
-# GET /ventas - Listar ventas con paginación
+# GET /ventas - Listar ventas con paginación (keyset)
 # -------------------------------------------------------------------
 
-@router.get("/", response_model=List[VentaResponse])
-def read_all_ventas(
-    skip: int = Query(0, ge=0),
+@router.get("/", response_model=VentaPageResponse)
+async def read_all_ventas(
+    after_id: Optional[int] = Query(None, ge=0), # Paginación: ID de la última venta recibida
     limit: int = Query(100, gt=0, le=100),
+    skip: Optional[int] = Query(None, ge=0, deprecated=True), # Obsoleto: usar after_id
     repository: VentaRepository = Depends(get_venta_repository)
 ):
     """
-    Obtiene la lista de todas las Ventas registradas con paginación.
+    Obtiene la lista de todas las Ventas registradas con paginación por cursor.
+    Para pedir la página siguiente se envía 'next_cursor' como 'after_id'.
     """
-    return repository.get_all(skip=skip, limit=limit)
+    ventas = await repository.get_all(after_id=after_id, limit=limit, skip=skip)
+    # Las filas ya vienen tipadas desde la base de datos: se serializan directamente
+    # con orjson, sin re-validar cada venta contra response_model (que queda para la documentación).
+    content = orjson.dumps({
+        # updated_at es interno (versión para el ETag), no forma parte de VentaResponse
+        "items": [venta.model_dump(exclude={"updated_at"}) for venta in ventas],
+        "next_cursor": ventas[-1].id if ventas else None,
+    }, option=ORJSON_DATETIME_OPTIONS)
+    return Response(content, media_type="application/json")
+
+# -------------------------------------------------------------------
+# GET /ventas/export - Exportar ventas en streaming (NDJSON)
+# -------------------------------------------------------------------
+# Nota: Se declara antes de /{venta_id} para que "export" no se tome como un ID.
+
+@router.get("/export")
+async def export_ventas(
+    after_id: Optional[int] = Query(None, ge=0), # Permite retomar la exportación por cursor
+    repository: VentaRepository = Depends(get_venta_repository)
+):
+    """
+    Exporta todas las Ventas como NDJSON (un objeto JSON por línea), enviándolas
+    a medida que se leen de la base de datos.
+    """
+    async def generate():
+        async for venta in repository.stream_all(after_id=after_id):
+            yield orjson.dumps(venta.model_dump(exclude={"updated_at"}), option=ORJSON_DATETIME_OPTIONS) + b"\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
 
 # -------------------------------------------------------------------
 # GET /ventas/{venta_id} - Obtener venta por ID (Respuesta simple)
 # -------------------------------------------------------------------
 
 @router.get("/{venta_id}", response_model=VentaResponse)
-def read_venta_by_id_simple(
+async def read_venta_by_id_simple(
     venta_id: int,
+    request: Request,
+    response: Response,
     repository: VentaRepository = Depends(get_venta_repository)
 ):
     """
     Obtiene una Venta específica por su ID.
+    Responde 304 sin cuerpo si el cliente envía en If-None-Match el ETag vigente.
     """
-    venta = repository.get_by_id(venta_id)
+    # La fila se lee por clave primaria igual que su versión: basta una sola consulta
+    venta = await repository.get_by_id(venta_id)
     if not venta:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Venta con ID {venta_id} no encontrada"
         )
+    etag = venta_etag(venta.id, venta.updated_at)
+    if is_not_modified(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers["ETag"] = etag
     return venta
 
 # -------------------------------------------------------------------
@@ -96,31 +197,36 @@ def read_venta_by_id_simple(
 # -------------------------------------------------------------------
 # Nota: Usamos VentaCreate para el PUT para asegurar que se envíen todos los campos
 @router.put("/{venta_id}", response_model=VentaResponse)
-def replace_venta(
+async def replace_venta(
     venta_id: int,
     venta_data: VentaCreate,
-    venta_repo: VentaRepository = Depends(get_venta_repository),
-    auto_repo: AutoRepository = Depends(get_auto_repository)
+    venta_repo: VentaRepository = Depends(get_venta_repository)
 ):
     """
     Actualiza completamente una Venta por su ID (PUT). Requiere todos los campos.
+    La existencia del nuevo auto_id la verifica la clave foránea en la base de datos.
     """
-    # 1. Verificar si el nuevo auto_id existe (si se está cambiando)
-    if not auto_repo.get_by_id(venta_data.auto_id):
+    # Convertir a VentaUpdate y realizar la actualización
+    venta_update_data = VentaUpdate.model_validate(venta_data.model_dump())
+    try:
+        updated_venta = await venta_repo.update(venta_id, venta_update_data)
+    except IntegrityError as e:
+        if is_foreign_key_violation(e):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Auto con ID {venta_data.auto_id} no encontrado. No se puede actualizar la venta."
+            )
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Auto con ID {venta_data.auto_id} no encontrado. No se puede actualizar la venta."
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Error al actualizar la venta: {e.orig}"
         )
 
-    # Convertir a VentaUpdate y realizar la actualización
-    venta_update_data = VentaUpdate.model_validate(venta_data.model_dump())
-    updated_venta = venta_repo.update(venta_id, venta_update_data)
-    
     if not updated_venta:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Venta con ID {venta_id} no encontrada"
         )
+    await invalidate_ventas_cache()
     return updated_venta
 
 # -------------------------------------------------------------------
@@ -128,19 +234,20 @@ def replace_venta(
 # -------------------------------------------------------------------
 
 @router.delete("/{venta_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_venta(
+async def delete_venta(
     venta_id: int,
     repository: VentaRepository = Depends(get_venta_repository)
 ):
     """
     Elimina una Venta por su ID.
     """
-    success = repository.delete(venta_id)
+    success = await repository.delete(venta_id)
     if not success:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Venta con ID {venta_id} no encontrada"
         )
+    await invalidate_ventas_cache()
     return 
 
 # -------------------------------------------------------------------
@@ -148,22 +255,25 @@ def delete_venta(
 # -------------------------------------------------------------------
 
 @router.get("/auto/{auto_id}", response_model=List[VentaResponse])
-def read_ventas_by_auto_id(
+@cache(expire=VENTAS_CACHE_EXPIRE, namespace=VENTAS_CACHE_NAMESPACE, key_builder=ventas_cache_key)
+async def read_ventas_by_auto_id(
     auto_id: int,
+    after_id: Optional[int] = Query(None, ge=0), # Paginación: ID de la última venta recibida
+    limit: int = Query(100, gt=0, le=1000),
     venta_repo: VentaRepository = Depends(get_venta_repository),
     auto_repo: AutoRepository = Depends(get_auto_repository)
 ):
     """
-    Obtiene todas las Ventas asociadas a un Auto específico.
+    Obtiene las Ventas asociadas a un Auto específico, paginadas por cursor.
     """
-    # Verificar si el Auto existe antes de buscar sus ventas
-    if not auto_repo.get_by_id(auto_id):
+    # Verificar si el Auto existe antes de buscar sus ventas (sin cargar la fila)
+    if not await auto_repo.exists(auto_id):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Auto con ID {auto_id} no encontrado"
         )
         
-    ventas = venta_repo.get_by_auto_id(auto_id)
+    ventas = await venta_repo.get_by_auto_id(auto_id, after_id=after_id, limit=limit)
     return ventas
 
 # -------------------------------------------------------------------
@@ -171,14 +281,19 @@ def read_ventas_by_auto_id(
 # -------------------------------------------------------------------
 # Nota: La ruta debe ser específica para evitar conflictos con /{venta_id}
 @router.get("/comprador/{nombre}", response_model=List[VentaResponse])
-def read_ventas_by_comprador(
+@cache(expire=VENTAS_CACHE_EXPIRE, namespace=VENTAS_CACHE_NAMESPACE, key_builder=ventas_cache_key)
+async def read_ventas_by_comprador(
     nombre: str,
+    after_id: Optional[int] = Query(None, ge=0), # Paginación: ID de la última venta recibida
+    limit: int = Query(100, gt=0, le=1000),
     repository: VentaRepository = Depends(get_venta_repository)
 ):
     """
-    Busca Ventas cuyo nombre de comprador contenga el texto especificado.
+    Busca Ventas por nombre de comprador, paginadas por cursor.
+    En PostgreSQL coincide con las palabras que empiezan con el texto indicado (p. ej. "Jua"
+    encuentra a "Juan"); en otros motores, con cualquier parte del nombre.
     """
-    ventas = repository.get_by_comprador(nombre)
+    ventas = await repository.get_by_comprador(nombre, after_id=after_id, limit=limit)
     return ventas
 
 # -------------------------------------------------------------------
@@ -186,20 +301,21 @@ def read_ventas_by_comprador(
 # -------------------------------------------------------------------
 
 @router.get("/{venta_id}/with-auto", response_model=VentaResponseWithAuto)
-def read_venta_with_auto(
+async def read_venta_with_auto(
     venta_id: int,
     repository: VentaRepository = Depends(get_venta_repository)
 ):
     """
     Obtiene una Venta específica por su ID, incluyendo los detalles del Auto vendido.
     """
-    venta = repository.get_by_id(venta_id)
+    # Sin ETag: la respuesta incluye el Auto, que puede cambiar sin que cambie la venta.
+    # Venta y auto se obtienen en una sola consulta, sin cargas perezosas posteriores.
+    venta = await repository.get_by_id_with_auto(venta_id)
     if not venta:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Venta con ID {venta_id} no encontrada"
         )
-    # Gracias a la relación definida en models.py, 'venta' ya incluye el objeto 'auto'.
     return venta
 
 # -------------------------------------------------------------------
@@ -207,39 +323,62 @@ def read_venta_with_auto(
 # -------------------------------------------------------------------
 
 @router.get("/filter/price", response_model=List[VentaResponse])
-def filter_ventas_by_price(
+@cache(expire=VENTAS_CACHE_EXPIRE, namespace=VENTAS_CACHE_NAMESPACE, key_builder=ventas_cache_key)
+async def filter_ventas_by_price(
     min_price: float = Query(0.0, ge=0, description="Precio mínimo de venta."),
     max_price: float = Query(float('inf'), ge=0, description="Precio máximo de venta."),
-    skip: int = Query(0, ge=0),
+    after_precio: Optional[float] = Query(None, ge=0, description="Cursor: precio de la última venta recibida."),
+    after_id: Optional[int] = Query(None, ge=0, description="Cursor: ID de la última venta recibida."),
     limit: int = Query(100, gt=0, le=100),
+    skip: Optional[int] = Query(None, ge=0, deprecated=True), # Obsoleto: usar el cursor
     repository: VentaRepository = Depends(get_venta_repository)
 ):
     """
-    Filtra ventas por un rango de precio.
+    Filtra ventas por un rango de precio, ordenadas por precio.
+    Para la página siguiente se envían el precio y el ID de la última venta recibida.
     """
     if min_price > max_price:
          raise HTTPException(status_code=400, detail="El precio mínimo no puede ser mayor que el precio máximo.")
-         
-    return repository.filter_by_price_range(min_price, max_price, skip=skip, limit=limit)
+    if (after_precio is None) != (after_id is None):
+        raise HTTPException(status_code=400, detail="El cursor requiere 'after_precio' y 'after_id' juntos.")
+
+    return await repository.filter_by_price_range(
+        min_price, max_price, after_precio=after_precio, after_id=after_id, limit=limit, skip=skip
+    )
 
 
 # -------------------------------------------------------------------
 # GET /filter/date - Filtrado por Rango de Fechas
 # -------------------------------------------------------------------
 
+def as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Interpreta las fechas sin zona horaria como UTC (igual que los modelos)."""
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
 @router.get("/filter/date", response_model=List[VentaResponse])
-def filter_ventas_by_date(
+@cache(expire=VENTAS_CACHE_EXPIRE, namespace=VENTAS_CACHE_NAMESPACE, key_builder=ventas_cache_key)
+async def filter_ventas_by_date(
     # FastAPI/Pydantic intentará parsear estas cadenas a objetos datetime
     start_date: datetime = Query(..., description="Fecha de inicio (ej: 2024-01-01T00:00:00)."),
     end_date: datetime = Query(..., description="Fecha de fin (ej: 2024-12-31T23:59:59)."),
-    skip: int = Query(0, ge=0),
+    after_fecha: Optional[datetime] = Query(None, description="Cursor: fecha de la última venta recibida."),
+    after_id: Optional[int] = Query(None, ge=0, description="Cursor: ID de la última venta recibida."),
     limit: int = Query(100, gt=0, le=100),
+    skip: Optional[int] = Query(None, ge=0, deprecated=True), # Obsoleto: usar el cursor
     repository: VentaRepository = Depends(get_venta_repository)
 ):
     """
-    Filtra ventas por un rango de fecha.
+    Filtra ventas por un rango de fecha, ordenadas por fecha.
+    Para la página siguiente se envían la fecha y el ID de la última venta recibida.
     """
+    start_date, end_date, after_fecha = as_utc(start_date), as_utc(end_date), as_utc(after_fecha)
     if start_date > end_date:
         raise HTTPException(status_code=400, detail="La fecha de inicio no puede ser posterior a la fecha de fin.")
-        
-    return repository.filter_by_date_range(start_date, end_date, skip=skip, limit=limit)
\ No newline at end of file
+    if (after_fecha is None) != (after_id is None):
+        raise HTTPException(status_code=400, detail="El cursor requiere 'after_fecha' y 'after_id' juntos.")
+
+    return await repository.filter_by_date_range(
+        start_date, end_date, after_fecha=after_fecha, after_id=after_id, limit=limit, skip=skip
+    )